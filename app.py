@@ -1,9 +1,14 @@
-import io, os, tempfile, shutil, subprocess
+import asyncio, atexit, hashlib, io, os, queue, threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from typing import List, Optional, Tuple
-from flask import Flask, request, jsonify, Response
-import requests
+import numpy as np
+from flask import Flask, request, jsonify, Response, stream_with_context
+import httpx
 from supabase import create_client, Client
+from storage3.utils import StorageException
 from flask_cors import CORS
+from scripts.enroll_multi_avg import EMB_DIM, EMBED_WORKERS, build_reference, embed_bytes, to_npy_bytes
 
 
 # ------------ Config via env ------------
@@ -14,66 +19,340 @@ STORAGE_BUCKET = os.environ.get("STORAGE_BUCKET", "reference_faces")
 # If your images live under a predictable prefix per patient, set this template:
 IMAGE_PREFIX_TEMPLATE = os.environ.get("IMAGE_PREFIX_TEMPLATE", "reference_faces/{patient_id}/")
 
-# Path to your script inside the container/source tree:
-SCRIPT_PATH = os.environ.get("SCRIPT_PATH", "scripts/enroll_multi_avg.py")
+# Where computed references and their input manifests are cached in the bucket:
+REFERENCE_NPY_TEMPLATE = os.environ.get("REFERENCE_NPY_TEMPLATE", "reference_faces/{patient_id}_m_arcface.npy")
+REFERENCE_MANIFEST_TEMPLATE = os.environ.get("REFERENCE_MANIFEST_TEMPLATE", "reference_faces/{patient_id}.manifest")
+
+# Number of parallel image downloads (HTTP connections) per request:
+DL_WORKERS = int(os.environ.get("DL_WORKERS", "16"))
+
+# Gateway errors are retried with exponential backoff (0.5s, 1s, 2s):
+DL_RETRIES = 3
+DL_RETRY_STATUSES = (502, 503, 504)
+DL_BACKOFF = 0.5
+
+# Most images accepted per /enroll call, the process-wide cap on image bytes
+# downloaded but not yet embedded, the largest single image, and how long (s)
+# a download waits for budget or a pooled connection before the request fails with 503:
+MAX_IMAGES = int(os.environ.get("MAX_IMAGES", "64"))
+MAX_INFLIGHT_BYTES = int(os.environ.get("MAX_INFLIGHT_BYTES", str(128 * 1024 * 1024)))
+MAX_IMAGE_BYTES = min(int(os.environ.get("MAX_IMAGE_BYTES", str(20 * 1024 * 1024))), MAX_INFLIGHT_BYTES)
+BUDGET_TIMEOUT = float(os.environ.get("BUDGET_TIMEOUT", "30"))
+BUDGET_POLL_INTERVAL = 0.05
+
+# Lifetime in seconds of the signed URLs used to fetch storage objects:
+SIGNED_URL_TTL = int(os.environ.get("SIGNED_URL_TTL", "300"))
+
+# Size of each chunk when streaming the response body:
+CHUNK_SIZE = 64 * 1024
+
+# Number of per-patient reference embeddings kept in memory (~2 KiB each):
+ENROLL_CACHE_SIZE = int(os.environ.get("ENROLL_CACHE_SIZE", "128"))
 
 # ---------------------------------------
 app = Flask(__name__)
 CORS(app)
 sb: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-def _list_storage_by_prefix(prefix: str) -> List[str]:
-    """List files under a prefix in the default bucket."""
+# Uploads of computed references run off the request path; drain them on shutdown.
+_UPLOADS = ThreadPoolExecutor(max_workers=2, thread_name_prefix="upload")
+atexit.register(_UPLOADS.shutdown, wait=True)
+
+# In-process LRU of complete references, keyed on (patient_id, sources).
+_ENROLL_CACHE: "OrderedDict[Tuple[str, Tuple[Tuple[str, str], ...]], bytes]" = OrderedDict()
+_ENROLL_CACHE_LOCK = threading.Lock()
+
+class NoImagesStaged(RuntimeError):
+    """None of the requested images could be downloaded."""
+
+class ImageTooLarge(RuntimeError):
+    """A single image is bigger than MAX_IMAGE_BYTES."""
+
+class DownloadBudgetExhausted(RuntimeError):
+    """Timed out waiting for room in the in-flight byte budget."""
+
+class _ByteBudget:
+    """Process-wide count of image bytes downloaded but not yet embedded."""
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, n: int) -> bool:
+        with self._lock:
+            if self._used + n > self._limit:
+                return False
+            self._used += n
+            return True
+
+    def release(self, n: int):
+        with self._lock:
+            self._used -= n
+
+    async def acquire(self, n: int, timeout: float):
+        """Wait for n bytes of room without blocking the event loop or any thread.
+
+        Raises DownloadBudgetExhausted if none frees up within timeout seconds.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not self.try_acquire(n):
+            if loop.time() >= deadline:
+                raise DownloadBudgetExhausted("server busy: too many images in flight, retry later")
+            await asyncio.sleep(BUDGET_POLL_INTERVAL)
+
+_INFLIGHT = _ByteBudget(MAX_INFLIGHT_BYTES)
+
+def _list_storage_by_prefix(prefix: str) -> List[Tuple[str, str]]:
+    """List files under a prefix in the default bucket as (path, version) pairs."""
     items = sb.storage.from_(STORAGE_BUCKET).list(prefix, {"limit": 1000})
-    return [f"{prefix.rstrip('/')}/{it['name']}" for it in (items or []) if it.get("name")]
+    out = []
+    for it in items or []:
+        if not it.get("name"):
+            continue
+        version = (it.get("metadata") or {}).get("eTag") or it.get("updated_at") or ""
+        out.append((f"{prefix.rstrip('/')}/{it['name']}", version))
+    return out
 
-def _download_from_storage_to(path_in_bucket: str, dest_file: str):
-    blob = sb.storage.from_(STORAGE_BUCKET).download(path_in_bucket)
-    with open(dest_file, "wb") as f:
-        f.write(blob)
+async def _read_within_budget(r: httpx.Response) -> Tuple[List[bytes], int]:
+    """Reserve budget for an open response and read its body.
 
-def _download_from_url_to(url: str, dest_file: str):
-    r = requests.get(url, timeout=30)
+    Returns the body chunks and the bytes reserved for them.
+    """
     r.raise_for_status()
-    with open(dest_file, "wb") as f:
-        f.write(r.content)
+    # Content-Length is the encoded size, so only trust it for unencoded bodies.
+    length = r.headers.get("content-length")
+    reserved = int(length) if length and "content-encoding" not in r.headers else MAX_IMAGE_BYTES
+    if reserved > MAX_IMAGE_BYTES:
+        raise ImageTooLarge(f"image larger than {MAX_IMAGE_BYTES} bytes")
+    await _INFLIGHT.acquire(reserved, BUDGET_TIMEOUT)
+    try:
+        chunks, size = [], 0
+        async for chunk in r.aiter_bytes():
+            size += len(chunk)
+            if size > reserved:
+                raise ImageTooLarge(f"image larger than {reserved} bytes")
+            chunks.append(chunk)
+    except BaseException:
+        _INFLIGHT.release(reserved)
+        raise
+    return chunks, reserved
 
-def _stage_images(temp_root: str, storage_paths: List[str], urls: List[str], patient_id: str) -> int:
-    """Create a folder for the patient and fill it with images."""
-    in_dir = os.path.join(temp_root, f"reference_faces/{patient_id}")
-    os.makedirs(in_dir, exist_ok=True)
-    count = 0
+async def _download_from_url(client: httpx.AsyncClient, url: str) -> Tuple[bytes, int]:
+    """Download url once its size fits in the in-flight budget.
 
-    for p in storage_paths:
+    Returns the body and the number of budget bytes reserved for it, which
+    the caller must release.
+    """
+    for attempt in range(DL_RETRIES + 1):
         try:
-            out_path = os.path.join(in_dir, f"sp_{count}.jpg")
-            _download_from_storage_to(p, out_path)
-            count += 1
-        except Exception:
-            continue
+            async with client.stream("GET", url) as r:
+                retry = r.status_code in DL_RETRY_STATUSES and attempt < DL_RETRIES
+                if not retry:
+                    chunks, reserved = await _read_within_budget(r)
+        except httpx.PoolTimeout as e:
+            # Connections are held while their downloads wait for budget, so a
+            # pool timeout means the same thing as running out of budget.
+            raise DownloadBudgetExhausted("server busy: too many images in flight, retry later") from e
+        if not retry:
+            break
+        # Back off only once the unread response has given its connection back.
+        await asyncio.sleep(DL_BACKOFF * 2 ** attempt)
+    body = b"".join(chunks)
+    # Hand back what the body didn't use (no Content-Length, or an encoded body).
+    _INFLIGHT.release(reserved - len(body))
+    return body, len(body)
+
+async def _download_all(urls: List[str], q: queue.Queue) -> int:
+    """Fetch every URL concurrently, handing each body to q as soon as it arrives.
+
+    Returns the number of successful downloads.
+    """
+    limits = httpx.Limits(max_connections=DL_WORKERS, max_keepalive_connections=DL_WORKERS)
+    # retries here covers connection errors only; status retries are in _download_from_url.
+    transport = httpx.AsyncHTTPTransport(retries=DL_RETRIES, http2=True, limits=limits)
 
-    for u in urls:
+    async def _download_then_enqueue(client: httpx.AsyncClient, url: str):
+        body, reserved = await _download_from_url(client, url)
+        # Label without the query string so signed-URL tokens stay out of the logs.
+        # q is unbounded (memory is bounded by _INFLIGHT), so this never blocks the loop.
+        q.put_nowait((url.split("?", 1)[0], body, reserved))
+
+    timeout = httpx.Timeout(30, pool=BUDGET_TIMEOUT)
+    async with httpx.AsyncClient(transport=transport, timeout=timeout, follow_redirects=True) as client:
+        results = await asyncio.gather(*[_download_then_enqueue(client, u) for u in urls], return_exceptions=True)
+    for r in results:
+        if isinstance(r, DownloadBudgetExhausted):
+            raise r
+    return sum(1 for r in results if not isinstance(r, BaseException))
+
+def _is_missing_object(e: Exception) -> bool:
+    if not isinstance(e, StorageException) or not e.args or not isinstance(e.args[0], dict):
+        return False
+    details = e.args[0]
+    text = f"{details.get('error', '')} {details.get('message', '')}".lower()
+    return details.get("statusCode") == 404 or "not found" in text or "not_found" in text
+
+def _signed_urls(paths: List[str]) -> List[str]:
+    """Sign every storage path in one API call; paths to missing objects are dropped.
+
+    Any other storage error propagates.
+    """
+    if not paths:
+        return []
+    bucket = sb.storage.from_(STORAGE_BUCKET)
+    try:
+        return [r["signedURL"] for r in bucket.create_signed_urls(paths, SIGNED_URL_TTL)]
+    except AttributeError:
+        # storage3 fails the whole batch on a missing object (signedURL is None),
+        # so sign each path on its own, concurrently, and skip the missing ones.
+        pass
+
+    def _sign_one(p: str) -> Optional[str]:
         try:
-            out_path = os.path.join(in_dir, f"url_{count}.jpg")
-            _download_from_url_to(u, out_path)
-            count += 1
-        except Exception:
-            continue
+            return bucket.create_signed_url(p, SIGNED_URL_TTL)["signedURL"]
+        except StorageException as e:
+            if _is_missing_object(e):
+                return None
+            raise
 
-    return count
-
-def _run_script_in(temp_root: str, patient_id: str) -> str:
-    """Run your script with cwd=temp_root so relative paths match your IN_GLOB/OUT_NPY."""
-    result = subprocess.run(
-        ["python", SCRIPT_PATH, patient_id],
-        cwd=temp_root,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"Script failed:\nSTDOUT:\n{result.stdout}\nSTDERR:\n{result.stderr}")
-    return result.stdout
+    with ThreadPoolExecutor(max_workers=min(DL_WORKERS, len(paths))) as ex:
+        return [u for u in ex.map(_sign_one, paths) if u]
+
+def _stage_and_embed(urls: List[str]) -> Tuple[int, int, np.ndarray]:
+    """Download images into memory and embed each one as soon as it arrives.
+
+    Returns the number of images downloaded, the number that were also
+    decoded and run through the detector, and an (N, EMB_DIM) array of the
+    embeddings of those with a face.
+    """
+    count = 0
+    embs = np.empty((len(urls), EMB_DIM), dtype=np.float32)
+    n_embs = 0
+    n_processed = 0
+    if not urls:
+        return count, n_processed, embs
+
+    n_consumers = min(len(urls), os.cpu_count() or 1, EMBED_WORKERS)
+    q: "queue.Queue[Optional[Tuple[str, bytes, int]]]" = queue.Queue()
+    lock = threading.Lock()
+
+    def _consume():
+        nonlocal n_embs, n_processed
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            label, body, reserved = item
+            try:
+                e = embed_bytes(body, label=label)
+            except Exception:
+                continue
+            finally:
+                del body, item
+                _INFLIGHT.release(reserved)
+            with lock:
+                n_processed += 1
+                if e is not None:
+                    embs[n_embs] = e
+                    n_embs += 1
+
+    consumers = [threading.Thread(target=_consume, daemon=True) for _ in range(n_consumers)]
+    for t in consumers:
+        t.start()
+
+    try:
+        count = asyncio.run(_download_all(urls, q))
+    finally:
+        for _ in consumers:
+            q.put(None)
+        for t in consumers:
+            t.join()
+
+    return count, n_processed, embs[:n_embs]
+
+def _enroll_npy_bytes(storage_paths: List[str], urls: List[str]) -> Tuple[bytes, bool]:
+    """Run the full download + embed pipeline and return the reference as .npy bytes.
+
+    The flag is True only if every source was signed, downloaded and decoded;
+    a reference built from a subset must not be cached.
+    """
+    # Storage paths become signed URLs so every image goes through the same HTTP client.
+    n, n_processed, embs = _stage_and_embed(_signed_urls(storage_paths) + urls)
+    if n == 0:
+        raise NoImagesStaged("no usable images staged")
+
+    complete = n_processed == len(storage_paths) + len(urls)
+    return to_npy_bytes(build_reference(embs)), complete
+
+def _sources_hash(sources: Tuple[Tuple[str, str], ...]) -> str:
+    return hashlib.sha256("|".join(f"{p}:{v}" for p, v in sorted(sources)).encode()).hexdigest()
+
+def _load_stored_reference(patient_id: str, digest: str) -> Optional[bytes]:
+    """Return the stored .npy if its manifest matches digest, else None."""
+    bucket = sb.storage.from_(STORAGE_BUCKET)
+    try:
+        manifest = bucket.download(REFERENCE_MANIFEST_TEMPLATE.format(patient_id=patient_id))
+        if manifest.decode().strip() != digest:
+            return None
+        return bucket.download(REFERENCE_NPY_TEMPLATE.format(patient_id=patient_id))
+    except Exception:
+        return None
+
+def _store_reference(patient_id: str, digest: str, npy_bytes: bytes):
+    """Upload the .npy first, then its manifest, so a matching manifest implies a current .npy."""
+    bucket = sb.storage.from_(STORAGE_BUCKET)
+    try:
+        bucket.upload(REFERENCE_NPY_TEMPLATE.format(patient_id=patient_id), npy_bytes,
+                      {"content-type": "application/octet-stream", "upsert": "true"})
+        bucket.upload(REFERENCE_MANIFEST_TEMPLATE.format(patient_id=patient_id), digest.encode(),
+                      {"content-type": "text/plain", "upsert": "true"})
+    except Exception:
+        app.logger.warning("Could not cache reference for %s", patient_id, exc_info=True)
+
+def _cache_get(key) -> Optional[bytes]:
+    with _ENROLL_CACHE_LOCK:
+        npy_bytes = _ENROLL_CACHE.get(key)
+        if npy_bytes is not None:
+            _ENROLL_CACHE.move_to_end(key)
+        return npy_bytes
+
+def _cache_put(key, npy_bytes: bytes):
+    with _ENROLL_CACHE_LOCK:
+        _ENROLL_CACHE[key] = npy_bytes
+        _ENROLL_CACHE.move_to_end(key)
+        while len(_ENROLL_CACHE) > ENROLL_CACHE_SIZE:
+            _ENROLL_CACHE.popitem(last=False)
+
+def _cached_enroll(patient_id: str, sources: Tuple[Tuple[str, str], ...]) -> bytes:
+    """Enroll from storage objects; keyed on each object's version so re-uploads miss.
+
+    Checks process memory, then the reference stored in the bucket, before
+    recomputing. Only references built from every source are remembered.
+    """
+    key = (patient_id, sources)
+    npy_bytes = _cache_get(key)
+    if npy_bytes is not None:
+        return npy_bytes
+
+    digest = _sources_hash(sources)
+    npy_bytes = _load_stored_reference(patient_id, digest)
+    if npy_bytes is not None:
+        _cache_put(key, npy_bytes)
+        return npy_bytes
+
+    npy_bytes, complete = _enroll_npy_bytes([p for p, _ in sources], [])
+    if complete:
+        _cache_put(key, npy_bytes)
+        _UPLOADS.submit(_store_reference, patient_id, digest, npy_bytes)
+    return npy_bytes
+
+def _iter_chunks(data: bytes):
+    """Yield data in CHUNK_SIZE slices."""
+    view = memoryview(data)
+    for i in range(0, len(view), CHUNK_SIZE):
+        yield view[i:i + CHUNK_SIZE].tobytes()
 
 @app.get("/health")
 def health():
@@ -98,39 +377,37 @@ def enroll():
 
     storage_paths = data.get("storage_paths") or []
     image_urls = data.get("image_urls") or []
+    if len(storage_paths) + len(image_urls) > MAX_IMAGES:
+        return jsonify(error=f"too many images (max {MAX_IMAGES})"), 413
 
+    objects: List[Tuple[str, str]] = []
     if not storage_paths and not image_urls:
         prefix = IMAGE_PREFIX_TEMPLATE.format(patient_id=patient_id)
-        storage_paths = _list_storage_by_prefix(prefix)
-        print(f"DEBUG: Found storage paths: {storage_paths}")
-
-
-    if not storage_paths and not image_urls:
-        return jsonify(error="no images found for this patient"), 404
+        objects = _list_storage_by_prefix(prefix)
+        print(f"DEBUG: Found storage paths: {[p for p, _ in objects]}")
+        if not objects:
+            return jsonify(error="no images found for this patient"), 404
+        # Keep the first MAX_IMAGES in sorted order so the cache key is stable.
+        objects = sorted(objects)[:MAX_IMAGES]
 
-    script_out_rel = f"reference_faces/{patient_id}_m_arcface.npy"
-    temp_root = tempfile.mkdtemp(prefix=f"enroll_{patient_id}_")
     try:
-        n = _stage_images(temp_root, storage_paths, image_urls, patient_id)
-        if n == 0:
-            return jsonify(error="no usable images staged"), 422
-
-        _ = _run_script_in(temp_root, patient_id)
-
-        npy_path = os.path.join(temp_root, script_out_rel)
-        if not os.path.exists(npy_path):
-            return jsonify(error="output .npy not found after script run"), 500
-
-        with open(npy_path, "rb") as f:
-            npy_bytes = f.read()
+        if objects:
+            npy_bytes = _cached_enroll(patient_id, tuple(objects))
+        else:
+            npy_bytes, _ = _enroll_npy_bytes(storage_paths, image_urls)
 
         filename = f"{patient_id}_m_arcface.npy"
-        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
-        return Response(npy_bytes, mimetype="application/octet-stream", headers=headers)
+        headers = {
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Content-Length": str(len(npy_bytes)),
+        }
+        return Response(stream_with_context(_iter_chunks(npy_bytes)), mimetype="application/octet-stream", headers=headers)
+    except NoImagesStaged as e:
+        return jsonify(error=str(e)), 422
+    except DownloadBudgetExhausted as e:
+        return jsonify(error=str(e)), 503
     except Exception as e:
         return jsonify(error=str(e)), 500
-    finally:
-        shutil.rmtree(temp_root, ignore_errors=True)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", "8080")))
\ No newline at end of file
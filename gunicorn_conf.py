@@ -0,0 +1,9 @@
+import os
+
+# InsightFace runs in-process, so use threaded workers: ONNX inference and
+# network I/O release the GIL and overlap across requests in one process.
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
@@ -1,36 +1,107 @@
-import cv2, numpy as np, glob, sys
+import cv2, numpy as np, glob, io, math, os, sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
+import onnxruntime
 from insightface.app import FaceAnalysis
 
-# Read the patient_id from the command-line arguments
-if len(sys.argv) < 2:
-    raise RuntimeError("Patient ID not provided as a command-line argument.")
+# Parallel images per enrollment, and ONNX threads per image (keep low so they don't oversubscribe).
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", "4"))
+ORT_INTRA_THREADS = int(os.environ.get("ORT_INTRA_THREADS", "1"))
 
-patient_id = sys.argv[1]
+# Length of a buffalo_l ArcFace embedding.
+EMB_DIM = 512
 
-# Make the paths dynamic using the patient_id
-IN_GLOB = f"reference_faces/{patient_id}/*.jpg"
-OUT_NPY = f"reference_faces/{patient_id}_m_arcface.npy"
+def _limit_intra_op_threads(fa: FaceAnalysis, n_threads: int):
+    """Rebuild each model's CPU session with a fixed intra-op thread count."""
+    opts = onnxruntime.SessionOptions()
+    opts.intra_op_num_threads = n_threads
+    for model in fa.models.values():
+        providers = model.session.get_providers()
+        if providers != ["CPUExecutionProvider"]:
+            continue
+        model.session = onnxruntime.InferenceSession(model.model_file, sess_options=opts, providers=providers)
 
-app = FaceAnalysis(name="buffalo_l")
-app.prepare(ctx_id=-1, det_size=(640, 640))
+# Load the models once per process; reused by every enrollment.
+# ONNX Runtime sessions are safe to run concurrently and release the GIL during inference.
+_APP = FaceAnalysis(name="buffalo_l")
+_APP.prepare(ctx_id=-1, det_size=(640, 640))
+_limit_intra_op_threads(_APP, ORT_INTRA_THREADS)
 
-embs = []
-for path in glob.glob(IN_GLOB):
-    img = cv2.imread(path)
-    faces = app.get(img)
+def _embed_array(img: Optional[np.ndarray], label: str) -> Optional[np.ndarray]:
+    if img is None:
+        print(f"[skip] could not decode {label}")
+        return None
+    faces = _APP.get(img)
     if not faces:
-        print(f"[skip] no face in {path}")
-        continue
+        print(f"[skip] no face in {label}")
+        return None
     face = max(faces, key=lambda f: f.det_score)
-    embs.append(face.normed_embedding.astype("float32"))
+    return face.normed_embedding.astype("float32")
 
-if not embs:
-    raise RuntimeError("No faces found in the enrollment images.")
+def embed_image(path: str) -> Optional[np.ndarray]:
+    """Return the normed embedding of the most confident face in the image, or None."""
+    return _embed_array(cv2.imread(path), path)
 
-# Average then re-normalize
-ref = np.mean(np.stack(embs, axis=0), axis=0)
-ref /= (np.linalg.norm(ref) + 1e-12)
-Path(OUT_NPY).parent.mkdir(parents=True, exist_ok=True)
-np.save(OUT_NPY, ref.astype("float32"))
-print("Saved averaged reference embedding to:", OUT_NPY)
\ No newline at end of file
+def embed_bytes(buf: bytes, label: str = "<buffer>") -> Optional[np.ndarray]:
+    """Same as embed_image, but decodes an encoded image held in memory.
+
+    Raises ValueError if buf is not a decodable image, so callers can tell a
+    bad download apart from an image without a face.
+    """
+    img = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"could not decode {label}")
+    return _embed_array(img, label)
+
+def build_reference(embs: np.ndarray) -> np.ndarray:
+    """Average an (N, EMB_DIM) float32 array of embeddings into a single unit-length reference."""
+    if len(embs) == 0:
+        raise RuntimeError("No faces found in the enrollment images.")
+
+    # Average then re-normalize
+    ref = embs.mean(axis=0, dtype=np.float32)
+    ref /= math.sqrt(float(ref @ ref)) + 1e-12
+    return ref
+
+def to_npy_bytes(ref: np.ndarray) -> bytes:
+    """Serialize the reference embedding in .npy format without touching disk."""
+    buf = io.BytesIO()
+    np.save(buf, ref.astype("float32"))
+    return buf.getvalue()
+
+def run_enroll(in_glob: str, out_npy: Optional[str] = None) -> bytes:
+    """Average the best face embedding of every image matching in_glob.
+
+    Returns the reference as .npy bytes, also saving it to out_npy when given.
+    """
+    paths = glob.glob(in_glob)
+    embs = np.empty((len(paths), EMB_DIM), dtype=np.float32)
+    idx = 0
+    if paths:
+        workers = min(len(paths), os.cpu_count() or 1, EMBED_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            for e in ex.map(embed_image, paths):
+                if e is not None:
+                    embs[idx] = e
+                    idx += 1
+
+    npy_bytes = to_npy_bytes(build_reference(embs[:idx]))
+    if out_npy:
+        Path(out_npy).parent.mkdir(parents=True, exist_ok=True)
+        Path(out_npy).write_bytes(npy_bytes)
+        print("Saved averaged reference embedding to:", out_npy)
+    return npy_bytes
+
+if __name__ == "__main__":
+    # Read the patient_id from the command-line arguments
+    if len(sys.argv) < 2:
+        raise RuntimeError("Patient ID not provided as a command-line argument.")
+
+    patient_id = sys.argv[1]
+
+    # Make the paths dynamic using the patient_id
+    IN_GLOB = f"reference_faces/{patient_id}/*.jpg"
+    OUT_NPY = f"reference_faces/{patient_id}_m_arcface.npy"
+
+    run_enroll(IN_GLOB, OUT_NPY)
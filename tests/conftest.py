@@ -0,0 +1,27 @@
+import os, sys, types
+import numpy as np
+import pytest
+
+# The app reads these at import time; nothing talks to Supabase in the tests.
+os.environ.setdefault("SUPABASE_URL", "https://example.supabase.co")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "header.payload.signature")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _fake_enroll_module() -> types.ModuleType:
+    """Stand-in for scripts.enroll_multi_avg so the tests don't load InsightFace models."""
+    m = types.ModuleType("scripts.enroll_multi_avg")
+    m.EMB_DIM = 512
+    m.EMBED_WORKERS = 2
+    m.embed_bytes = lambda buf, label="<buffer>": np.ones(512, dtype=np.float32) / np.sqrt(512)
+    m.build_reference = lambda embs: embs.mean(axis=0)
+    m.to_npy_bytes = lambda ref: ref.astype("float32").tobytes()
+    return m
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setitem(sys.modules, "scripts.enroll_multi_avg", _fake_enroll_module())
+    monkeypatch.delitem(sys.modules, "app", raising=False)
+    import app
+    yield app
+    sys.modules.pop("app", None)
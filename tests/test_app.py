@@ -0,0 +1,435 @@
+import asyncio, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import httpx
+import numpy as np
+import pytest
+from storage3.utils import StorageException
+
+def test_signed_urls_batch(app_module):
+    bucket = mock.Mock()
+    bucket.create_signed_urls.return_value = [{"signedURL": "https://s/a"}, {"signedURL": "https://s/b"}]
+    with mock.patch.object(app_module, "sb") as sb:
+        sb.storage.from_.return_value = bucket
+        assert app_module._signed_urls(["a", "b"]) == ["https://s/a", "https://s/b"]
+    bucket.create_signed_url.assert_not_called()
+
+def test_signed_urls_skips_missing_objects(app_module):
+    bucket = mock.Mock()
+    bucket.create_signed_urls.side_effect = AttributeError("'NoneType' object has no attribute 'lstrip'")
+
+    def _sign_one(path, ttl):
+        if path == "missing":
+            raise StorageException({"statusCode": 400, "error": "not_found", "message": "Object not found"})
+        return {"signedURL": f"https://s/{path}"}
+
+    bucket.create_signed_url.side_effect = _sign_one
+    with mock.patch.object(app_module, "sb") as sb:
+        sb.storage.from_.return_value = bucket
+        assert app_module._signed_urls(["a", "missing", "b"]) == ["https://s/a", "https://s/b"]
+
+def test_signed_urls_propagates_batch_errors(app_module):
+    bucket = mock.Mock()
+    bucket.create_signed_urls.side_effect = StorageException({"statusCode": 401, "error": "Unauthorized"})
+    with mock.patch.object(app_module, "sb") as sb:
+        sb.storage.from_.return_value = bucket
+        with pytest.raises(StorageException):
+            app_module._signed_urls(["a", "b"])
+    bucket.create_signed_url.assert_not_called()
+
+def test_signed_urls_propagates_per_path_errors(app_module):
+    bucket = mock.Mock()
+    bucket.create_signed_urls.side_effect = AttributeError("'NoneType' object has no attribute 'lstrip'")
+    bucket.create_signed_url.side_effect = StorageException({"statusCode": 503, "error": "Service Unavailable"})
+    with mock.patch.object(app_module, "sb") as sb:
+        sb.storage.from_.return_value = bucket
+        with pytest.raises(StorageException):
+            app_module._signed_urls(["a", "b"])
+
+def test_signed_urls_signs_paths_concurrently(app_module):
+    bucket = mock.Mock()
+    bucket.create_signed_urls.side_effect = AttributeError("'NoneType' object has no attribute 'lstrip'")
+    barrier = threading.Barrier(3, timeout=5)
+
+    def _sign_one(path, ttl):
+        barrier.wait()
+        return {"signedURL": f"https://s/{path}"}
+
+    bucket.create_signed_url.side_effect = _sign_one
+    with mock.patch.object(app_module, "sb") as sb:
+        sb.storage.from_.return_value = bucket
+        assert app_module._signed_urls(["a", "b", "c"]) == ["https://s/a", "https://s/b", "https://s/c"]
+
+def test_download_retries_gateway_errors(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "DL_BACKOFF", 0)
+    statuses = iter([503, 502, 200])
+
+    def _handler(request):
+        status = next(statuses)
+        return httpx.Response(status, content=b"img" if status == 200 else b"")
+
+    async def _run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(_handler)) as client:
+            return await app_module._download_from_url(client, "https://img/a.jpg")
+
+    body, reserved = asyncio.run(_run())
+    assert body == b"img"
+    app_module._INFLIGHT.release(reserved)
+
+def test_download_gives_up_after_retries(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "DL_BACKOFF", 0)
+    calls = []
+
+    def _handler(request):
+        calls.append(request)
+        return httpx.Response(504)
+
+    async def _run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(_handler)) as client:
+            return await app_module._download_from_url(client, "https://img/a.jpg")
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(_run())
+    assert len(calls) == app_module.DL_RETRIES + 1
+
+def _serve(monkeypatch, app_module, handler):
+    """Route every download made by _download_all through handler."""
+    monkeypatch.setattr(app_module.httpx, "AsyncHTTPTransport", lambda **kw: httpx.MockTransport(handler))
+
+def test_byte_budget_try_acquire_and_release(app_module):
+    budget = app_module._ByteBudget(10)
+    assert budget.try_acquire(6)
+    assert not budget.try_acquire(5)
+    assert budget.try_acquire(4)
+    budget.release(6)
+    assert budget.try_acquire(5)
+
+def test_byte_budget_acquire_times_out(app_module):
+    budget = app_module._ByteBudget(10)
+    assert budget.try_acquire(10)
+    with pytest.raises(app_module.DownloadBudgetExhausted):
+        asyncio.run(budget.acquire(1, timeout=0.1))
+
+def test_byte_budget_acquire_waits_for_release(app_module):
+    budget = app_module._ByteBudget(10)
+    assert budget.try_acquire(10)
+    threading.Timer(0.1, budget.release, args=(10,)).start()
+    asyncio.run(budget.acquire(10, timeout=5))
+    assert not budget.try_acquire(1)
+
+def test_download_rejects_large_content_length(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_IMAGE_BYTES", 8)
+    monkeypatch.setattr(app_module, "_INFLIGHT", app_module._ByteBudget(100))
+
+    async def _run():
+        handler = lambda request: httpx.Response(200, content=b"x" * 9)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await app_module._download_from_url(client, "https://img/a.jpg")
+
+    with pytest.raises(app_module.ImageTooLarge):
+        asyncio.run(_run())
+    assert app_module._INFLIGHT.try_acquire(100)
+
+def test_download_stops_reading_unsized_body_past_limit(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_IMAGE_BYTES", 8)
+    monkeypatch.setattr(app_module, "_INFLIGHT", app_module._ByteBudget(100))
+    yielded = []
+
+    async def _endless():
+        while True:
+            yielded.append(1)
+            yield b"x" * 4
+
+    async def _run():
+        handler = lambda request: httpx.Response(200, content=_endless())
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await app_module._download_from_url(client, "https://img/a.jpg")
+
+    with pytest.raises(app_module.ImageTooLarge):
+        asyncio.run(_run())
+    assert len(yielded) < 10
+    assert app_module._INFLIGHT.try_acquire(100)
+
+def test_download_reserves_only_body_size(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_IMAGE_BYTES", 50)
+    monkeypatch.setattr(app_module, "_INFLIGHT", app_module._ByteBudget(100))
+
+    async def _body():
+        yield b"abc"
+
+    async def _run():
+        handler = lambda request: httpx.Response(200, content=_body())
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await app_module._download_from_url(client, "https://img/a.jpg")
+
+    body, reserved = asyncio.run(_run())
+    assert (body, reserved) == (b"abc", 3)
+    assert app_module._INFLIGHT.try_acquire(97)
+    assert not app_module._INFLIGHT.try_acquire(1)
+
+def test_concurrent_requests_under_tight_budget_finish(app_module, monkeypatch):
+    # More downloads waiting on budget than any executor has threads must not deadlock.
+    monkeypatch.setattr(app_module, "_INFLIGHT", app_module._ByteBudget(4 * 1024))
+    monkeypatch.setattr(app_module, "MAX_IMAGE_BYTES", 1024)
+    monkeypatch.setattr(app_module, "BUDGET_TIMEOUT", 10)
+    _serve(monkeypatch, app_module, lambda request: httpx.Response(200, content=b"x" * 1024))
+
+    def _slow_embed(buf, label="<buffer>"):
+        time.sleep(0.005)
+        return np.ones(app_module.EMB_DIM, dtype=np.float32)
+
+    monkeypatch.setattr(app_module, "embed_bytes", _slow_embed)
+    urls = [f"https://img/{i}.jpg" for i in range(40)]
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        results = list(ex.map(lambda _: app_module._stage_and_embed(urls), range(8)))
+
+    assert all(n == n_processed == len(embs) == len(urls) for n, n_processed, embs in results)
+    assert app_module._INFLIGHT.try_acquire(4 * 1024)
+
+def test_enroll_rejects_too_many_images(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_IMAGES", 2)
+    client = app_module.app.test_client()
+    r = client.post("/enroll", json={"patient_id": "p1", "image_urls": ["a", "b", "c"]})
+    assert r.status_code == 413
+
+def test_enroll_caps_listed_objects(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_IMAGES", 2)
+    listed = [("reference_faces/p1/c.jpg", "3"), ("reference_faces/p1/a.jpg", "1"), ("reference_faces/p1/b.jpg", "2")]
+    monkeypatch.setattr(app_module, "_list_storage_by_prefix", lambda prefix: listed)
+    seen = []
+    monkeypatch.setattr(app_module, "_cached_enroll", lambda pid, sources: seen.append(sources) or b"npy")
+
+    r = app_module.app.test_client().post("/enroll", json={"patient_id": "p1"})
+    assert r.status_code == 200
+    assert r.data == b"npy"
+    assert seen == [(("reference_faces/p1/a.jpg", "1"), ("reference_faces/p1/b.jpg", "2"))]
+
+def test_enroll_returns_503_when_budget_exhausted(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "_INFLIGHT", app_module._ByteBudget(1024))
+    monkeypatch.setattr(app_module, "MAX_IMAGE_BYTES", 1024)
+    monkeypatch.setattr(app_module, "BUDGET_TIMEOUT", 0.1)
+    assert app_module._INFLIGHT.try_acquire(1024)
+    _serve(monkeypatch, app_module, lambda request: httpx.Response(200, content=b"x" * 10))
+
+    r = app_module.app.test_client().post("/enroll", json={"patient_id": "p1", "image_urls": ["https://img/a.jpg"]})
+    assert r.status_code == 503
+
+class _InlineExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+def _bucket_with(files):
+    """A storage bucket mock backed by a dict, recording upload order."""
+    bucket = mock.Mock()
+    bucket.uploads = []
+
+    def _download(path):
+        if path not in files:
+            raise RuntimeError("Object not found")
+        return files[path]
+
+    def _upload(path, data, options):
+        bucket.uploads.append(path)
+        files[path] = data
+
+    bucket.download.side_effect = _download
+    bucket.upload.side_effect = _upload
+    return bucket
+
+def test_load_stored_reference_manifest_hit(app_module):
+    files = {"reference_faces/p1.manifest": b"abc\n", "reference_faces/p1_m_arcface.npy": b"npy"}
+    with mock.patch.object(app_module, "sb") as sb:
+        sb.storage.from_.return_value = _bucket_with(files)
+        assert app_module._load_stored_reference("p1", "abc") == b"npy"
+
+def test_load_stored_reference_manifest_mismatch(app_module):
+    files = {"reference_faces/p1.manifest": b"old", "reference_faces/p1_m_arcface.npy": b"npy"}
+    with mock.patch.object(app_module, "sb") as sb:
+        bucket = _bucket_with(files)
+        sb.storage.from_.return_value = bucket
+        assert app_module._load_stored_reference("p1", "new") is None
+    assert bucket.download.call_count == 1
+
+def test_load_stored_reference_missing_manifest(app_module):
+    with mock.patch.object(app_module, "sb") as sb:
+        sb.storage.from_.return_value = _bucket_with({})
+        assert app_module._load_stored_reference("p1", "abc") is None
+
+def test_store_reference_uploads_npy_before_manifest(app_module):
+    files = {}
+    with mock.patch.object(app_module, "sb") as sb:
+        bucket = _bucket_with(files)
+        sb.storage.from_.return_value = bucket
+        app_module._store_reference("p1", "abc", b"npy")
+    assert bucket.uploads == ["reference_faces/p1_m_arcface.npy", "reference_faces/p1.manifest"]
+    assert files["reference_faces/p1.manifest"] == b"abc"
+
+def test_cached_enroll_uses_stored_reference(app_module, monkeypatch):
+    sources = (("reference_faces/p1/a.jpg", "1"),)
+    monkeypatch.setattr(app_module, "_load_stored_reference", lambda pid, digest: b"stored")
+    enroll = mock.Mock()
+    monkeypatch.setattr(app_module, "_enroll_npy_bytes", enroll)
+    assert app_module._cached_enroll("p1", sources) == b"stored"
+    enroll.assert_not_called()
+
+def test_store_reference_logs_failures(app_module, caplog):
+    with mock.patch.object(app_module, "sb") as sb:
+        sb.storage.from_.return_value.upload.side_effect = RuntimeError("storage down")
+        app_module._store_reference("p1", "abc", b"npy")
+    assert "Could not cache reference for p1" in caplog.text
+
+def test_cached_enroll_stores_complete_result(app_module, monkeypatch):
+    sources = (("reference_faces/p1/a.jpg", "1"), ("reference_faces/p1/b.jpg", "2"))
+    monkeypatch.setattr(app_module, "_UPLOADS", _InlineExecutor())
+    monkeypatch.setattr(app_module, "_load_stored_reference", lambda pid, digest: None)
+    monkeypatch.setattr(app_module, "_enroll_npy_bytes", lambda paths, urls: (b"fresh", True))
+    stored = []
+    monkeypatch.setattr(app_module, "_store_reference", lambda *a: stored.append(a))
+    assert app_module._cached_enroll("p1", sources) == b"fresh"
+    assert stored == [("p1", app_module._sources_hash(sources), b"fresh")]
+
+def test_cached_enroll_does_not_store_partial_result(app_module, monkeypatch):
+    sources = (("reference_faces/p1/a.jpg", "1"), ("reference_faces/p1/b.jpg", "2"))
+    monkeypatch.setattr(app_module, "_load_stored_reference", lambda pid, digest: None)
+    monkeypatch.setattr(app_module, "_UPLOADS", _InlineExecutor())
+    monkeypatch.setattr(app_module, "_enroll_npy_bytes", lambda paths, urls: (b"partial", False))
+    stored = []
+    monkeypatch.setattr(app_module, "_store_reference", lambda *a: stored.append(a))
+    assert app_module._cached_enroll("p1", sources) == b"partial"
+    assert stored == []
+
+def test_enroll_npy_bytes_flags_failed_downloads(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "_signed_urls", lambda paths: [])
+    _serve(monkeypatch, app_module, lambda request: httpx.Response(404 if "bad" in str(request.url) else 200, content=b"x"))
+    _, complete = app_module._enroll_npy_bytes([], ["https://img/ok.jpg", "https://img/bad.jpg"])
+    assert not complete
+    _, complete = app_module._enroll_npy_bytes([], ["https://img/ok.jpg"])
+    assert complete
+
+def test_enroll_npy_bytes_flags_unsigned_paths(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "_signed_urls", lambda paths: ["https://img/a.jpg"])
+    _serve(monkeypatch, app_module, lambda request: httpx.Response(200, content=b"x"))
+    _, complete = app_module._enroll_npy_bytes(["a", "missing"], [])
+    assert not complete
+
+def test_enroll_npy_bytes_flags_undecodable_images(app_module, monkeypatch):
+    def _embed(buf, label="<buffer>"):
+        if buf == b"junk":
+            raise ValueError("could not decode")
+        return np.ones(app_module.EMB_DIM, dtype=np.float32)
+
+    monkeypatch.setattr(app_module, "embed_bytes", _embed)
+    monkeypatch.setattr(app_module, "_signed_urls", lambda paths: [])
+    _serve(monkeypatch, app_module, lambda request: httpx.Response(200, content=b"junk" if "junk" in str(request.url) else b"x"))
+    _, complete = app_module._enroll_npy_bytes([], ["https://img/ok.jpg", "https://img/junk.jpg"])
+    assert not complete
+
+def test_cached_enroll_memoises_complete_result(app_module, monkeypatch):
+    sources = (("reference_faces/p1/a.jpg", "1"),)
+    monkeypatch.setattr(app_module, "_UPLOADS", _InlineExecutor())
+    monkeypatch.setattr(app_module, "_store_reference", lambda *a: None)
+    monkeypatch.setattr(app_module, "_load_stored_reference", lambda pid, digest: None)
+    enroll = mock.Mock(return_value=(b"fresh", True))
+    monkeypatch.setattr(app_module, "_enroll_npy_bytes", enroll)
+    assert app_module._cached_enroll("p1", sources) == b"fresh"
+    assert app_module._cached_enroll("p1", sources) == b"fresh"
+    assert enroll.call_count == 1
+
+def test_cached_enroll_does_not_memoise_partial_result(app_module, monkeypatch):
+    sources = (("reference_faces/p1/a.jpg", "1"), ("reference_faces/p1/b.jpg", "2"))
+    monkeypatch.setattr(app_module, "_load_stored_reference", lambda pid, digest: None)
+    enroll = mock.Mock(side_effect=[(b"partial", False), (b"fresh", True)])
+    monkeypatch.setattr(app_module, "_enroll_npy_bytes", enroll)
+    monkeypatch.setattr(app_module, "_UPLOADS", _InlineExecutor())
+    monkeypatch.setattr(app_module, "_store_reference", lambda *a: None)
+    assert app_module._cached_enroll("p1", sources) == b"partial"
+    assert app_module._cached_enroll("p1", sources) == b"fresh"
+
+def test_enroll_cache_evicts_least_recently_used(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "ENROLL_CACHE_SIZE", 2)
+    app_module._cache_put("a", b"1")
+    app_module._cache_put("b", b"2")
+    assert app_module._cache_get("a") == b"1"
+    app_module._cache_put("c", b"3")
+    assert app_module._cache_get("b") is None
+    assert app_module._cache_get("a") == b"1"
+    assert app_module._cache_get("c") == b"3"
+
+def test_downloads_follow_redirects(app_module, monkeypatch):
+    def _handler(request):
+        if request.url.path == "/short":
+            return httpx.Response(302, headers={"location": "https://cdn/img.jpg"})
+        return httpx.Response(200, content=b"img")
+
+    _serve(monkeypatch, app_module, _handler)
+    n, n_processed, embs = app_module._stage_and_embed(["https://short.link/short"])
+    assert (n, n_processed, len(embs)) == (1, 1, 1)
+
+def test_download_backs_off_after_closing_response(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "DL_BACKOFF", 0)
+    streams = []
+
+    class _Body(httpx.AsyncByteStream):
+        closed = False
+
+        async def __aiter__(self):
+            yield b""
+
+        async def aclose(self):
+            self.closed = True
+
+    def _handler(request):
+        streams.append(_Body())
+        return httpx.Response(503 if len(streams) == 1 else 200, stream=streams[-1])
+
+    open_at_sleep = []
+    real_sleep = asyncio.sleep
+
+    async def _sleep(delay):
+        open_at_sleep.append(not streams[0].closed)
+        await real_sleep(delay)
+
+    monkeypatch.setattr(app_module.asyncio, "sleep", _sleep)
+
+    async def _run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(_handler)) as client:
+            return await app_module._download_from_url(client, "https://img/a.jpg")
+
+    asyncio.run(_run())
+    assert open_at_sleep == [False]
+
+class _SlowImageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(0.5)
+        body = b"x" * 1024
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def slow_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SlowImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+def test_pool_timeout_while_waiting_for_budget_is_503_not_partial(app_module, monkeypatch, slow_server):
+    # One real pooled connection: the first download holds it (0.5s response plus
+    # ~0.8s waiting for budget) past the 1s pool timeout of the one queued behind it.
+    monkeypatch.setattr(app_module, "DL_WORKERS", 1)
+    monkeypatch.setattr(app_module, "BUDGET_TIMEOUT", 1.0)
+    monkeypatch.setattr(app_module, "MAX_IMAGE_BYTES", 1024)
+    monkeypatch.setattr(app_module, "_INFLIGHT", app_module._ByteBudget(1024))
+    assert app_module._INFLIGHT.try_acquire(1024)
+    threading.Timer(1.3, app_module._INFLIGHT.release, args=(1024,)).start()
+
+    urls = [f"{slow_server}/{i}.jpg" for i in range(2)]
+    with pytest.raises(app_module.DownloadBudgetExhausted):
+        app_module._stage_and_embed(urls)